@@ -1,6 +1,5 @@
 import numpy as np
 import cv2
-from collections import deque
 import gym
 import yaml
 from skimage import color
@@ -72,71 +71,53 @@ class SkipFrames(gym.Wrapper):
         return self.env.reset()
 
 
-class LazyFrames(object):
-    def __init__(self, frames):
-        """
-        This object ensures that common frames between the observations are
-        only stored once. It exists purely to optimize memory usage which can
-        be huge for DQN's 1M frames replay buffers. This object should only be
-        converted to numpy array before being passed to the model. You'd not
-        believe how complex the previous solution was.
+class StackedFrames(object):
+    def __init__(self, shape, k):
+        """Preallocated buffer holding the k last frames of the given shape, stacked along the channels axis.
 
-        Source: https://github.com/openai/sonic-on-ray/blob/master/sonic_on_ray/sonic_on_ray.py
+        New frames are shifted in place, so no per step allocations are needed other than the copy handed
+        out as observation, which is C-contiguous and laid out from the oldest to the newest frame.
         """
-        self._frames = frames
-        self._out = None
+        height, width, channels = shape
+        self._buf = np.zeros((height, width, channels * k), dtype=np.uint8)
+        self._frames = self._buf.reshape((height, width, k, channels))  # View indexing frames by position
 
-    def _force(self):
-        if self._out is None:
-            self._out = np.concatenate(self._frames, axis=2)
-            self._frames = None
-        return self._out
+    def reset(self, frame):
+        """Fills all positions in the stack with the given frame"""
+        self._frames[:] = frame[:, :, None, :]
 
-    def __array__(self, dtype=None):
-        out = self._force()
-        if dtype is not None:
-            out = out.astype(dtype)
-        return out
+    def append(self, frame):
+        """Shifts out the oldest frame, and stacks a new one"""
+        self._frames[:, :, :-1] = self._frames[:, :, 1:]
+        self._frames[:, :, -1] = frame
 
-    def __len__(self):
-        return len(self._force())
-
-    def __getitem__(self, i):
-        return self._force()[i]
+    def get(self):
+        """Returns a copy of the stacked frames, safe to keep after further steps"""
+        return self._buf.copy()
 
 
 class FrameStack(gym.Wrapper):
     def __init__(self, env, k=4):
         """Stack the k last frames.
-        Returns a lazy array, which is much more memory efficient.
-        See Also
-        --------
-        baselines.common.atari_wrappers.LazyFrames
 
         Source: https://github.com/openai/sonic-on-ray/blob/master/sonic_on_ray/sonic_on_ray.py
         """
         gym.Wrapper.__init__(self, env)
         self.k = k
-        self.frames = deque([], maxlen=k)
         shp = env.observation_space.shape
+        self.frames = StackedFrames(shp, k)
         self.observation_space = gym.spaces.Box(low=0, high=255,
                                                 shape=(shp[0], shp[1], shp[2] * k),
                                                 dtype=np.uint8)
 
     def reset(self):
-        ob = self.env.reset()
-        for _ in range(self.k):
-            self.frames.append(ob)
-        return self._get_ob()
+        self.frames.reset(self.env.reset())
+        return self.frames.get()
 
     def step(self, action):
         ob, reward, done, info = self.env.step(action)
         self.frames.append(ob)
-        return self._get_ob(), reward, done, info
-
-    def _get_ob(self):
-        assert len(self.frames) == self.k
-        return LazyFrames(list(self.frames))
+        return self.frames.get(), reward, done, info
 
 
 class WarpFrame(gym.ObservationWrapper):
@@ -158,14 +139,75 @@ class WarpFrame(gym.ObservationWrapper):
         )
 
     def observation(self, frame):
-        if self.togray:
-            frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
-        frame = cv2.resize(frame, (self.width, self.height),
-                           interpolation=cv2.INTER_AREA)
-        if self.togray:
-            return frame[:, :, None]
-        else:
-            return frame[:, :, :]
+        return warp_frame(frame, self.width, self.height, self.togray)
+
+
+class AtariLike(gym.Wrapper):
+    """Gym wrapper that skips frames, warps them and stacks them, as in the usual Atari preprocessing
+
+    Equivalent to chaining SkipFrames, WarpFrame and FrameStack, but running all of them in a single
+    wrapper call per agent step. If maxpool=2 the pixelwise max of the last two skipped frames is
+    returned, which removes the flickering of sprites drawn only on alternate frames.
+    """
+    def __init__(self, env, skip=4, pad_action=None, maxpool=1, togray=True, k=4):
+        gym.Wrapper.__init__(self, env)
+        assert maxpool in {1, 2}
+        self._skip = skip
+        self._pad_action = pad_action
+        self._maxpool = maxpool
+        self._two_frame_buf = np.zeros((2, ) + env.observation_space.shape, dtype=np.uint8)
+        self.width = 84
+        self.height = 84
+        self.togray = togray
+        self.k = k
+        self.frames = StackedFrames((self.height, self.width, 1 if togray else 3), k)
+        self.observation_space = gym.spaces.Box(low=0, high=255,
+                                                shape=(self.height, self.width, (1 if togray else 3) * k),
+                                                dtype=np.uint8)
+
+    def reset(self):
+        self.frames.reset(warp_frame(self.env.reset(), self.width, self.height, self.togray))
+        return self.frames.get()
+
+    def step(self, action):
+        """Repeat action, sum reward, max over last observations, warp and stack."""
+        total_reward = 0.0
+        obs = done = info = None
+        for i in range(self._skip):
+            if i == 0 or self._pad_action is None:
+                doact = action
+            else:
+                doact = self._pad_action
+            obs, reward, done, info = self.env.step(doact)
+            if self._maxpool == 2 and i >= self._skip - 2:
+                self._two_frame_buf[i % 2] = obs
+            total_reward += reward
+            if done:
+                break  # At break, frame buffer might contain incoherent frames, but it doesn't matter at episode end
+
+        if self._maxpool == 2:
+            obs = cv2.max(self._two_frame_buf[0], self._two_frame_buf[1])
+        self.frames.append(warp_frame(obs, self.width, self.height, self.togray))
+        return self.frames.get(), total_reward, done, info
+
+
+class NativeGrayscale(gym.ObservationWrapper):
+    """Replaces the RGB observations of a gym Atari environment with the grayscale screen produced by ALE
+
+    This saves the RGB to grayscale conversion of every frame in later wrappers. The RGB screen is still fetched
+    by the environment. The grayscale screen is written into a reused buffer, so the returned frame is overwritten
+    in the next step: later wrappers must copy it.
+    """
+    def __init__(self, env):
+        gym.ObservationWrapper.__init__(self, env)
+        self._ale = env.unwrapped.ale
+        shp = env.observation_space.shape
+        self.observation_space = gym.spaces.Box(low=0, high=255, shape=(shp[0], shp[1], 1), dtype=np.uint8)
+        self._buf = np.zeros(self.observation_space.shape, dtype=np.uint8)
+
+    def observation(self, frame):
+        self._ale.getScreenGrayscale(self._buf)
+        return self._buf
 
 
 class RewardScaler(gym.RewardWrapper):
@@ -181,15 +223,6 @@ class RewardScaler(gym.RewardWrapper):
         return reward * self.rewardscaling
 
 
-class RewardClipper(gym.RewardWrapper):
-    """Clips the rewards to {-1, 0, 1}
-
-    Can be useful to prevent the agent getting crazy about very large rewards.
-    """
-    def reward(self, reward):
-        return np.sign(reward)
-
-
 class RewardTimeDump(gym.RewardWrapper):
     """Adds a small negative reward per step.
 
@@ -204,6 +237,24 @@ class RewardTimeDump(gym.RewardWrapper):
         return reward - self.penalty
 
 
+class RewardShaper(gym.RewardWrapper):
+    """Scales and optionally clips rewards to {-1, 0, 1}, in a single wrapper
+
+    Replaces chaining RewardScaler and a reward clipper, with a single wrapper call for every step.
+    Clipping can be useful to prevent the agent getting crazy about very large rewards.
+    """
+    def __init__(self, env, rewardscaling=1, clip=False):
+        self.rewardscaling = rewardscaling
+        self.clip = clip
+        gym.RewardWrapper.__init__(self, env)
+
+    def reward(self, reward):
+        reward = reward * self.rewardscaling
+        if self.clip:
+            reward = float((reward > 0) - (reward < 0))
+        return reward
+
+
 class NoopResetEnv(gym.Wrapper):
     """Performs no-action a random number of frames at the beginning of each episode
 
@@ -245,16 +296,16 @@ class ButtonsRemapper(gym.ActionWrapper):
         gameconfig = ACTIONS_CONFIG["games"][game]
         gamepad, actions = gameconfig["gamepad"], gameconfig["actions"]
         buttonmap = ACTIONS_CONFIG["gamepads"][gamepad]
-        self._actions = []
-        for action in actions:
-            arr = np.array([False] * len(buttonmap))
+        self._actions = np.zeros((len(actions), len(buttonmap)), dtype=bool)
+        for i, action in enumerate(actions):
             for button in action:
-                arr[buttonmap.index(button)] = True
-            self._actions.append(arr)
+                self._actions[i, buttonmap.index(button)] = True
+        # Rows are handed out without copying, so protect them from modifications
+        self._actions.flags.writeable = False
         self.action_space = gym.spaces.Discrete(len(self._actions))
 
     def action(self, a):
-        return self._actions[a].copy()
+        return self._actions[a]
 
 
 class MovieRecorder(gym.ObservationWrapper):
@@ -326,6 +377,20 @@ class ProcessedMovieRecorder(MovieRecorder):
 
 # General functions
 
+def warp_frame(frame, width, height, togray):
+    """Resizes a frame to the given dimensions, optionally turning it to a single grayscale channel
+
+    Frames that are already grayscale are not converted again.
+    """
+    if togray and frame.ndim == 3 and frame.shape[2] > 1:
+        frame = cv2.cvtColor(np.ascontiguousarray(frame), cv2.COLOR_RGB2GRAY)
+    frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+    if togray:
+        return frame[:, :, None]
+    else:
+        return frame[:, :, :]
+
+
 def id_generator(size=6, chars=string.ascii_uppercase + string.digits):
     """Generates a random id for a filename"""
     return ''.join(random.choice(chars) for _ in range(size))
@@ -6,11 +6,11 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from torch.distributions import Categorical
 import argparse
-import skimage
-from skimage import color
-from collections import deque
+import threading
+import queue
+import cv2
+from numba import njit
 import envs
 
 
@@ -19,6 +19,8 @@ eps = np.finfo(np.float32).eps.item()
 
 # Initialize device
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+# Network inputs always have the same shape, so let cuDNN benchmark and pick the fastest convolution algorithms
+torch.backends.cudnn.benchmark = True
 
 
 def make_env(game, state, rewardscaling=1, pad_action=None):
@@ -31,21 +33,85 @@ def make_env(game, state, rewardscaling=1, pad_action=None):
 
 
 def prepro(image):
-    """ prepro uint8 frame into tensor image"""
-    image = image[::4, ::4, :]  # downsample by factor of 4
-    image = color.rgb2gray(image)  # turn to grayscale
-    return image - 0.5  # 0-center
+    """ prepro uint8 frame into a smaller uint8 grayscale image
+
+    Frames are kept as uint8 to save memory and transfers, the network casts them to floats.
+    """
+    height, width = image.shape[:2]
+    # Downsample by factor of 4 before the color conversion, so that it processes fewer bytes
+    image = cv2.resize(image, (width // 4, height // 4), interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)  # turn to grayscale
 
 
-def discount_rewards(r, gamma=0.99):
-    """Take 1D float array of rewards and compute clipped discounted reward"""
-    discounted_r = np.zeros_like(r)
-    running_add = 0
-    for t in reversed(range(0, len(r))):
-        running_add = running_add * gamma + r[t]
-        discounted_r[t] = running_add
+# Luma weights for RGB to grayscale conversion, same as OpenCV's
+GRAY_WEIGHTS = torch.tensor([0.299, 0.587, 0.114], device=device)
 
-    return discounted_r
+
+def prepro_device(image):
+    """ prepro version running in the device: uploads the raw uint8 frame and downsamples it there
+
+    Returns a uint8 tensor in the device, with the same size as the output of prepro.
+    """
+    raw = torch.from_numpy(image).to(device, non_blocking=True)
+    gray = torch.matmul(raw.float(), GRAY_WEIGHTS)  # turn to grayscale
+    gray = F.avg_pool2d(gray[None, None], 4)[0, 0]  # downsample by factor of 4
+    return gray.round_().to(torch.uint8)
+
+
+class FrameBuffer:
+    """Ring buffer holding the last k processed frames of an episode
+
+    Each new frame overwrites the oldest one, so only a single frame is copied per step.
+    """
+    def __init__(self, frame, k=4):
+        if isinstance(frame, torch.Tensor):
+            self._buf = frame.new_empty((k,) + tuple(frame.shape))
+            self._orders = [(i + torch.arange(k, device=frame.device)) % k for i in range(k)]
+        else:
+            self._buf = np.empty((k,) + frame.shape, dtype=frame.dtype)
+            self._orders = [(i + np.arange(k)) % k for i in range(k)]
+        self.reset(frame)
+
+    def reset(self, frame):
+        """Fills the buffer with copies of the given frame"""
+        self._buf[:] = frame
+        self._idx = 0
+
+    def append(self, frame):
+        """Replaces the oldest frame in the buffer with a new one"""
+        self._buf[self._idx] = frame
+        self._idx = (self._idx + 1) % len(self._buf)
+
+    def state(self):
+        """Returns a new array (or tensor) with the buffered frames stacked from oldest to newest"""
+        return self._buf[self._orders[self._idx]]
+
+
+@njit(cache=True, fastmath=True)
+def _gae(values, rewards, terminals, lastvalue, gamma, lam):
+    """Compiled recurrence of the Generalized Advantage Estimator, resetting at episode ends"""
+    n = values.shape[0]
+    advantages = np.empty(n, np.float32)
+    lastadvantage = 0.0
+    nextvalue = lastvalue
+    for t in range(n - 1, -1, -1):
+        nonterminal = 0.0 if terminals[t] else 1.0
+        delta = rewards[t] + gamma * nextvalue * nonterminal - values[t]
+        lastadvantage = delta + gamma * lam * nonterminal * lastadvantage
+        advantages[t] = lastadvantage
+        nextvalue = values[t]
+    return advantages
+
+
+def fuse_conv_bn(conv, bn):
+    """Folds the running statistics of a batch normalization layer into the preceding convolution
+
+    Returns the weight and bias of a single convolution equivalent to both layers in evaluation mode.
+    """
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    weight = conv.weight * scale.view(-1, 1, 1, 1)
+    bias = (conv.bias - bn.running_mean) * scale + bn.bias
+    return weight.detach(), bias.detach()
 
 
 class Policy(nn.Module):
@@ -72,43 +138,50 @@ class Policy(nn.Module):
         self.valuehead = nn.Linear(512, 1)
 
     def forward(self, x):
+        x = x.float().div(255.0).sub_(0.5)  # uint8 frames to 0-centered floats
         x = F.selu(self.bn1((self.conv1(x))))
         x = F.selu(self.bn2((self.conv2(x))))
         x = F.selu(self.bn3((self.conv3(x))))
         x = F.selu(self.dense(x.view(x.size(0), -1)))
-        return F.softmax(self.actionshead(x)), self.valuehead(x)
+        return self.actionshead(x), self.valuehead(x)
 
-    def _outdist(self, state):
-        """Computes the probatility distribution of activating each output unit, given an input state"""
-        probs, _ = self(state.float().unsqueeze(0))
-        return Categorical(probs)
+    def fuse(self):
+        """Rebuilds the convolutions used for inference, with batch normalization folded into them
 
-    def select_action(self, state):
-        """Selects an action following the policy
-
-        Returns the selected action and the log probabilities of that action being selected.
+        Must be called again every time the network parameters change.
         """
-        m = self._outdist(state)
-        action = m.sample()
-        return action, m.log_prob(action)
-
-    def action_logprobs_value(self, state, action):
-        """Returns the logprobabilities of performing a given action at given state under this policy
-
-        Also returns the value of the current state, for convenience.
+        with torch.no_grad():
+            self._fused = [(conv.stride,) + fuse_conv_bn(conv, bn)
+                           for conv, bn in [(self.conv1, self.bn1), (self.conv2, self.bn2), (self.conv3, self.bn3)]]
+
+    def forward_fused(self, x):
+        """Inference-only forward pass, running the fused convolutions built by fuse()"""
+        with torch.no_grad():
+            x = x.float().div(255.0).sub_(0.5)  # uint8 frames to 0-centered floats
+            for stride, weight, bias in self._fused:
+                x = F.selu(F.conv2d(x, weight, bias, stride=stride))
+            x = F.selu(self.dense(x.view(x.size(0), -1)))
+            return self.actionshead(x), self.valuehead(x)
+
+    def select_action(self, states):
+        """Selects an action following the policy for each state in a batch
+
+        Returns the selected actions and the log probabilities of those actions being selected.
         """
-        probs, value = self(state.float().unsqueeze(0))
-        m = Categorical(probs)
-        return m.log_prob(action), value
+        logits, _ = self.forward_fused(states)
+        logprobs = F.log_softmax(logits, dim=1)
+        actions = torch.multinomial(torch.exp(logprobs), 1)
+        return actions[:, 0], logprobs.gather(1, actions)[:, 0]
 
-    def value(self, state):
-        """Estimates the value of the given state"""
-        _, value = self(state.float().unsqueeze(0))
-        return value
+    def evaluate(self, states, actions):
+        """Returns the log probabilities of performing some actions in a batch of states, and the states values"""
+        logits, value = self(states)
+        return F.log_softmax(logits, dim=1).gather(1, actions.unsqueeze(1))[:, 0], value[:, 0]
 
-    def entropy(self, state):
-        """Returns the entropy of the policy for a given state"""
-        return torch.sum(self._outdist(state).entropy())
+    def value(self, states):
+        """Estimates the value of each state in a batch"""
+        _, value = self(states)
+        return value[:, 0]
 
 
 def runepisode(env, policy, episodesteps, render, windowlength=4):
@@ -118,30 +191,30 @@ def runepisode(env, policy, episodesteps, render, windowlength=4):
         (observation, processed observation, logprobabilities, action, reward, terminal)
     """
     observation = env.reset()
-    x = prepro(observation)
-    statesqueue = deque([x for _ in range(windowlength)], maxlen=windowlength)
-    xbatch = np.stack(statesqueue, axis=0)
+    frames = FrameBuffer(prepro(observation), windowlength)
+    xbatch = frames.state()
     history = []
     for _ in range(episodesteps):
         if render:
             env.render()
         st = torch.tensor(xbatch).to(device)
-        action, p = policy.select_action(st)
+        action, p = policy.select_action(st.unsqueeze(0))
         newobservation, reward, done, info = env.step(action.tolist()[0])
         history.append((observation, xbatch, p, action, reward, done))
         if done:
             break
         observation = newobservation
-        x = prepro(observation)
-        statesqueue.append(x)
-        xbatch = np.stack(statesqueue, axis=0)
+        frames.append(prepro(observation))
+        xbatch = frames.state()
     return history
 
 
-def experiencegenerator(env, policy, episodesteps=None, render=False, windowlength=4, verbose=True):
+def experiencegenerator(env, policy, episodesteps=None, render=False, windowlength=4, verbose=True,
+                        preprocessor=prepro):
     """Generates experience from the environment.
 
     If the environment episode ends, it is resetted to continue acquiring experience.
+    Frames are processed with the given preprocessor function, either prepro or prepro_device.
 
     Yields experiences as tuples in the form:
         (observation, processed observation, logprobabilities, action, reward,
@@ -154,9 +227,8 @@ def experiencegenerator(env, policy, episodesteps=None, render=False, windowleng
     while True:
         # Reinitialize environment
         observation = env.reset()
-        x = prepro(observation)
-        statesqueue = deque([x for _ in range(windowlength)], maxlen=windowlength)
-        xbatch = np.stack(statesqueue, axis=0)
+        frames = FrameBuffer(preprocessor(observation), windowlength)
+        xbatch = frames.state()
         step = 0
 
         # Steps
@@ -164,13 +236,14 @@ def experiencegenerator(env, policy, episodesteps=None, render=False, windowleng
         while True:
             if render:
                 env.render()
-            action, lp = policy.select_action(torch.tensor(xbatch).to(device))
+            # States from prepro_device are already in the device, those from prepro are wrapped without copies
+            st = xbatch if isinstance(xbatch, torch.Tensor) else torch.from_numpy(xbatch).to(device)
+            action, lp = policy.select_action(st.unsqueeze(0))
             action = int(action)
             lp = float(lp)
             newobservation, reward, done, info = env.step(action)
-            x = prepro(newobservation)
-            statesqueue.append(x)
-            newxbatch = np.stack(statesqueue, axis=0)
+            frames.append(preprocessor(newobservation))
+            newxbatch = frames.state()
             yield (observation, xbatch, lp, action, reward, newobservation, newxbatch, done)
             rewards += reward
 
@@ -188,6 +261,42 @@ def experiencegenerator(env, policy, episodesteps=None, render=False, windowleng
                   f"100-episodes average reward {np.mean(episoderewards[-100:]):.2f}")
 
 
+def gatherexperiences(expgen, states, logprobs, actions, rewards, terminals):
+    """Fills preallocated experience arrays, one per field, with consecutive experiences from a generator
+
+    The states array must have one extra position at the end, where the processed observation
+    following the last gathered experience is stored.
+    """
+    newstate = None
+    for i in range(len(logprobs)):
+        _, states[i], logprobs[i], actions[i], rewards[i], _, newstate, terminals[i] = next(expgen)
+    states[len(logprobs)] = newstate
+
+
+def backgroundgenerator(generator, maxsize):
+    """Runs a generator in a background thread, prefetching up to maxsize of its items
+
+    Useful to keep the environment playing while the GPU is busy with network updates. PyTorch
+    releases the GIL during its heavy computations, so a thread is enough for both to overlap.
+    Exceptions raised by the generator are propagated to the consumer.
+    """
+    items = queue.Queue(maxsize=maxsize)
+
+    def produce():
+        try:
+            for item in generator:
+                items.put((item, None))
+        except Exception as e:
+            items.put((None, e))
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item, error = items.get()
+        if error is not None:
+            raise error
+        yield item
+
+
 def loadnetwork(env, checkpoint, restart, game):
     """Loads the policy network from a checkpoint"""
     if restart:
@@ -201,19 +310,20 @@ def loadnetwork(env, checkpoint, restart, game):
             policy = Policy(env, game)
             print(f"Checkpoint {checkpoint} not found, created policy network from scratch")
     policy.to(device)
+    policy.fuse()
     return policy
 
 
-def ppostep(policy, optimizer, states, actions, baseprobs, values, advantages, epscut, gradclip,
+def ppostep(policy, optimizer, states, actions, baselogprobs, values, advantages, epscut, gradclip,
             valuecoef, entcoef):
     """Performs a step of Proximal Policy Optimization
 
     Arguments:
         - policy: policy network to optimize.
         - optimizer: pytorch optimizer algorithm to use.
-        - states: iterable of gathered experience states
-        - actions: iterable of performed actions in the states
-        - basepros: current base probabilities of performing those actions
+        - states: tensor with a batch of gathered experience states
+        - actions: tensor of performed actions in the states
+        - baselogprobs: current base log probabilities of performing those actions
         - values: estimated values for each state
         - advantages: estimated advantage values for those actions
         - epscut: epsilon cut for policy gradient update
@@ -226,17 +336,18 @@ def ppostep(policy, optimizer, states, actions, baseprobs, values, advantages, e
     Reference: https://arxiv.org/pdf/1707.06347.pdf
     """
     optimizer.zero_grad()
-    # Compute action probabilities and state values for current network parameters
-    logprobs, newvalues = zip(*[policy.action_logprobs_value(st, ac) for st, ac in zip(states, actions)])
-    newvalues = torch.stack([x[0][0] for x in newvalues])
-    # Policy Gradients loss (advantages)
-    newprobs = [torch.exp(logp) for logp in logprobs]
-    probratios = [newprob / prob for prob, newprob in zip(baseprobs, newprobs)]
-    clippings = [torch.min(rt * adv, torch.clamp(rt, 1 - epscut, 1 + epscut) * adv)
-                 for rt, adv in zip(probratios, advantages)]
-    pgloss = -torch.cat(clippings).mean()
-    # Entropy loss
-    entropyloss = - entcoef * torch.mean(torch.stack([policy.entropy(st) for st in states]))
+    # Compute action probabilities and state values for current network parameters, in a single batched pass
+    logits, newvalues = policy(states)
+    newvalues = newvalues[:, 0]
+    logprobs = F.log_softmax(logits, dim=1)
+    # Policy Gradients loss (advantages), with probability ratios computed in log space
+    newlogprobs = logprobs.gather(1, actions.unsqueeze(1))[:, 0]
+    probratios = torch.exp(newlogprobs - baselogprobs)
+    clippings = torch.min(probratios * advantages, torch.clamp(probratios, 1 - epscut, 1 + epscut) * advantages)
+    pgloss = -clippings.mean()
+    # Entropy loss, computed in closed form from the same action log probabilities
+    entropies = -torch.sum(torch.exp(logprobs) * logprobs, dim=1)
+    entropyloss = - entcoef * torch.mean(entropies)
     # Value estimation loss
     # (newvalue - [advantage + oldvalue])^2, that is, make new value closer to estimated error in old estimate
     # A clipped version of the loss is also included
@@ -249,13 +360,14 @@ def ppostep(policy, optimizer, states, actions, baseprobs, values, advantages, e
     loss = pgloss + valueloss + entropyloss
     # Optimizer step, with clipped gradients to a max norm to avoid exploding gradients
     loss.backward()
-    torch.nn.utils.clip_grad_norm(policy.parameters(), gradclip)
+    torch.nn.utils.clip_grad_norm_(policy.parameters(), gradclip)
     optimizer.step()
+    policy.fuse()
 
     return loss, pgloss, valueloss, entropyloss
 
 
-def generalized_advantage_estimation(values, rewards, lastvalue, gamma, lam):
+def generalized_advantage_estimation(values, rewards, terminals, lastvalue, gamma, lam):
     """Computes a Generalized Advantage Estimator (GAE)
 
     This estimator allows computing advantages for any state, even if the current episode
@@ -264,6 +376,7 @@ def generalized_advantage_estimation(values, rewards, lastvalue, gamma, lam):
     Arguments:
         - values: estimated values for each state
         - rewards: iterable of obtained rewards for those states
+        - terminals: iterable of flags marking whether the episode ended after each state
         - lastvalue: estimated value after all the steps above have been performed
         - gamma: rewards discount parameter
         - lam: GAE discount parameter.
@@ -272,9 +385,14 @@ def generalized_advantage_estimation(values, rewards, lastvalue, gamma, lam):
 
     Reference: https://arxiv.org/pdf/1506.02438.pdf
     """
-    allvalues = np.asarray(values.tolist() + [lastvalue])
-    deltas = rewards + gamma * allvalues[1:] - allvalues[:-1]
-    advantages = discount_rewards(deltas, gamma*lam)
+    advantages = _gae(
+        np.asarray(values, dtype=np.float32),
+        np.asarray(rewards, dtype=np.float32),
+        np.asarray(terminals, dtype=np.bool_),
+        float(lastvalue),
+        gamma,
+        lam
+    )
     # Normalize advantages
     advantages = (advantages - np.mean(advantages)) / (np.std(advantages) + eps)
     return advantages.astype(np.float32)
@@ -296,7 +414,26 @@ def train(game, state=None, render=False, checkpoint='policygradient.pt', episod
     print(policy)
     print("device: {}".format(device))
     optimizer = optim.Adam(policy.parameters(), lr=lr_start)
-    expgen = experiencegenerator(env, policy, episodesteps=episodesteps, render=render)
+    # With a GPU, frames are preprocessed in there and experience states never leave it
+    ondevice = device.type == "cuda"
+    expgen = experiencegenerator(env, policy, episodesteps=episodesteps, render=render,
+                                 preprocessor=prepro_device if ondevice else prepro)
+    # Play in the background while optimizing. Rendering must stay in the main thread, though.
+    # Prefetching is kept small, so that few experiences come from a policy older than that of the next update
+    if not render:
+        expgen = backgroundgenerator(expgen, maxsize=minibatchsize)
+
+    # Experience buffers, one array per field, reused across iterations
+    nsamples = minibatchsize * nminibatches
+    stateshape = (4,) + prepro(np.zeros(env.observation_space.shape, dtype=np.uint8)).shape
+    # States have an extra position for the state following the last experience
+    allstates = torch.empty((nsamples + 1,) + stateshape, dtype=torch.uint8, device=device)
+    logprobsbuffer = np.empty(nsamples, dtype=np.float32)
+    actionsbuffer = np.empty(nsamples, dtype=np.int64)
+    rewardsbuffer = np.empty(nsamples, dtype=np.float32)
+    terminalsbuffer = np.empty(nsamples, dtype=np.bool_)
+    # Losses of each minibatch in an optimizer epoch: total, policy gradient, value, entropy
+    losseshistory = torch.empty((nminibatches, 4), device=device)
 
     totalsteps = 0
     networkupdates = 0
@@ -307,37 +444,53 @@ def train(game, state=None, render=False, checkpoint='policygradient.pt', episod
         adjust_learning_rate(optimizer, lr)
 
         # Gather experiences
-        samples = [next(expgen) for _ in range(minibatchsize*nminibatches)]
-        totalsteps += minibatchsize * nminibatches
-        _, states, logprobs, actions, rewards, _, newstates, terminals = zip(*samples)
-        probs = [np.exp(lp) for lp in logprobs]
-        values = torch.stack([policy.value(torch.tensor(st).to(device)).detach()[0][0] for st in states])
-        lastvalue = policy.value(torch.tensor(newstates[-1]).to(device)).detach()[0][0]
+        # In the CPU the states tensor shares memory with a numpy array, which is filled directly
+        gatherexperiences(expgen, allstates if ondevice else allstates.numpy(), logprobsbuffer, actionsbuffer,
+                          rewardsbuffer, terminalsbuffer)
+        totalsteps += nsamples
+        states = allstates
+        # Update the batch normalization running statistics with the new experiences. They are then frozen (eval mode)
+        # for value estimation and policy updates, so that those compute the same function as the fused rollouts
+        policy.train()
+        with torch.no_grad():
+            for i in range(0, nsamples, minibatchsize):
+                policy(states[i:i+minibatchsize])
+        policy.eval()
+        policy.fuse()
+        actions = torch.from_numpy(actionsbuffer).to(device)
+        # Base log probabilities are recomputed with the current policy, since experiences gathered in the background
+        # may come from older ones. That way probability ratios start at 1 in the policy update
+        with torch.no_grad():
+            logprobs, values = map(torch.cat, zip(*[
+                policy.evaluate(states[i:i+minibatchsize], actions[i:i+minibatchsize])
+                for i in range(0, nsamples, minibatchsize)
+            ]))
+            lastvalue = policy.value(states[nsamples:])[0]
         # Compute advantages
         advantages = generalized_advantage_estimation(
-            values=values,
-            rewards=rewards,
+            values=values.cpu().numpy(),
+            rewards=rewardsbuffer,
+            terminals=terminalsbuffer,
             lastvalue=lastvalue,
             gamma=gamma,
             lam=lam
         )
         advantages = torch.tensor(advantages).to(device)
-        print(f"Explored {minibatchsize*nminibatches} steps")
+        print(f"Explored {nsamples} steps")
 
         # Optimizer epochs
         for optstep in range(optimizersteps):
-            losseshistory = []
             # Random shuffle of experiences
-            idx = np.random.permutation(range(len(samples)))
+            idx = torch.randperm(nsamples, device=device)
             # One step of SGD for each minibatch
             for i in range(nminibatches):
                 batchidx = idx[i*minibatchsize:(i+1)*minibatchsize]
                 losses = ppostep(
                     policy=policy,
                     optimizer=optimizer,
-                    states=[torch.tensor(states[i]).to(device) for i in batchidx],
-                    actions=[torch.tensor(actions[i]).to(device) for i in batchidx],
-                    baseprobs=[probs[i] for i in batchidx],
+                    states=states[batchidx],
+                    actions=actions[batchidx],
+                    baselogprobs=logprobs[batchidx],
                     advantages=advantages[batchidx],
                     values=values[batchidx],
                     epscut=epscut,
@@ -345,13 +498,13 @@ def train(game, state=None, render=False, checkpoint='policygradient.pt', episod
                     valuecoef=valuecoef,
                     entcoef=entcoef
                 )
-                losseshistory.append(losses)
+                losseshistory[i] = torch.stack(losses).detach()
 
-            loss, pgloss, valueloss, entropyloss = map(torch.stack, zip(*losseshistory))
-            print(f"Optimizer iteration {optstep+1}: loss {torch.mean(loss):.3f} (pg {torch.mean(pgloss):.3f} "
-                  f"value {torch.mean(valueloss):.3f} entropy {torch.mean(entropyloss):.3f})")
+            loss, pgloss, valueloss, entropyloss = losseshistory.mean(dim=0).tolist()
+            print(f"Optimizer iteration {optstep+1}: loss {loss:.3f} (pg {pgloss:.3f} "
+                  f"value {valueloss:.3f} entropy {entropyloss:.3f})")
 
-        del states, rewards, probs, actions, terminals
+        del states, logprobs, actions
 
         # Save policy network from time to time
         networkupdates += 1
@@ -383,7 +536,7 @@ def test(game, state=None, render=False, checkpoint='policygradient.pt', saveani
         # Save animation (if requested)
         if saveanimations:
             envs.saveanimation(list(observations), f"{checkpoint}_episode{episode}.mp4")
-            envs.saveanimation([skimage.img_as_ubyte(color.gray2rgb(st[-1] + 0.5)) for st in states],
+            envs.saveanimation([cv2.cvtColor(st[-1], cv2.COLOR_GRAY2RGB) for st in states],
                                f"{checkpoint}_processed_episode{episode}.mp4")
 
         episode += 1
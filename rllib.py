@@ -3,19 +3,21 @@
 import retro
 import argparse
 import ray
-from ray.rllib.agents import ppo, impala, dqn, registry
+from ray.rllib.agents import registry
 from ray.tune import register_env
 from ray.tune.logger import pretty_print
 import envs
 import models
 import time
 import numpy as np
-from functools import partial
-import rnd
+from functools import lru_cache
+import importlib
 import json
-import subprocess
+import os
+import sys
+import pickle
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import gym
-import copy
 
 
 def wrap_env(env, rewardscaling=1, skipframes=4, maxpoolframes=1, pad_action=None, keepcolor=False,
@@ -33,22 +35,64 @@ def wrap_env(env, rewardscaling=1, skipframes=4, maxpoolframes=1, pad_action=Non
         makeprocessedmovie: save videos of episodes in the format the RL agent sees them. Similar parameters to
             makemovie
         cliprewards: clip rewards to range [-1, 1]
+
+    Frames are kept as uint8 arrays through all the wrappers, casting them to floats is left to the model.
     """
     env = envs.NoopResetEnv(env)
-    env = envs.RewardScaler(env, rewardscaling)
-    if cliprewards:
-        env = envs.RewardClipper(env)
-    env = envs.SkipFrames(env, skip=skipframes, pad_action=pad_action, maxpool=maxpoolframes)
-    if makemovie is not None:
-        env = envs.MovieRecorder(env, fileprefix="raw", mode=makemovie)
-    env = envs.WarpFrame(env, togray=not keepcolor)
-    if makeprocessedmovie is not None:
-        env = envs.ProcessedMovieRecorder(env, fileprefix="processed", mode=makeprocessedmovie)
-    env = envs.FrameStack(env, stackframes)
-    env = envs.RewardTimeDump(env, timepenalty)
+    env = envs.RewardShaper(env, rewardscaling, clip=cliprewards)
+    if makemovie is None and makeprocessedmovie is None and maxpoolframes <= 2:
+        # Fused frame preprocessing, when no intermediate frames need to be recorded
+        env = envs.AtariLike(env, skip=skipframes, pad_action=pad_action, maxpool=maxpoolframes,
+                             togray=not keepcolor, k=stackframes)
+    else:
+        env = envs.SkipFrames(env, skip=skipframes, pad_action=pad_action, maxpool=maxpoolframes)
+        if makemovie is not None:
+            env = envs.MovieRecorder(env, fileprefix="raw", mode=makemovie)
+        env = envs.WarpFrame(env, togray=not keepcolor)
+        if makeprocessedmovie is not None:
+            env = envs.ProcessedMovieRecorder(env, fileprefix="processed", mode=makeprocessedmovie)
+        env = envs.FrameStack(env, stackframes)
+    # Time penalty is charged once per agent step, not per emulator frame
+    if timepenalty:
+        env = envs.RewardTimeDump(env, timepenalty)
     return env
 
 
+class EnvCreator:
+    """Picklable environment creator, as required by register_env
+
+    Ray ships the creator to remote workers and environment actors, so it is better defined at module level
+    than as a lambda closure. The env_config argument passed by Ray is ignored.
+    """
+    def __init__(self, creator, *args, **kwargs):
+        self.creator = creator
+        self.args = args
+        self.kwargs = kwargs
+
+    def __call__(self, env_config=None):
+        return self.creator(*self.args, **self.kwargs)
+
+
+@ray.remote
+class RemoteEnv:
+    """Ray actor that keeps an environment alive in its own process
+
+    The emulator, ROM and game state stay resident in the actor, only actions, observations and rewards are exchanged.
+    """
+    def __init__(self, envcreator):
+        self.env = envcreator()
+
+    def action_space(self):
+        return self.env.action_space
+
+    def reset(self):
+        return np.asarray(self.env.reset())
+
+    def step(self, action):
+        state, reward, done, info = self.env.step(action)
+        return np.asarray(state), reward, done, info
+
+
 def retro_env_creator(game, state, **kwargs):
     """Returns a function that creates a new retro environment the given game, state, and wrapper configuration"""
     base = retro.make(game=game, state=state)
@@ -61,14 +105,17 @@ def register_retro(game, state, registername="retro-v0", **kwargs):
 
     Returns a creator function that can be used to instantiate the registered environment on demand.
     """
-    env_creator = lambda env_config: retro_env_creator(game, state, **kwargs)
+    env_creator = EnvCreator(retro_env_creator, game, state, **kwargs)
     register_env(registername, env_creator)
-    return partial(env_creator, {})
+    return env_creator
 
 
 def gym_atari_env_creator(game, **kwargs):
     """Returns a function that creates a new gym atari environment with given game, state, and wrapper configuration"""
     base = gym.make(game)
+    # Use the grayscale screen from the emulator, unless colors are needed for the model or the raw movies
+    if not kwargs.get("keepcolor", False) and kwargs.get("makemovie") is None:
+        base = envs.NativeGrayscale(base)
     return wrap_env(base, **kwargs)
 
 
@@ -77,12 +124,10 @@ def register_gym_atari(game, registername="retro-v0", **kwargs):
 
     Returns a creator function that can be used to instantiate the registered environment on demand.
     """
-    wrapconf = copy.copy(kwargs)
-    if "state" in wrapconf:
-        del wrapconf["state"]
-    env_creator = lambda env_config: gym_atari_env_creator(game, **wrapconf)
+    wrapconf = {key: value for key, value in kwargs.items() if key != "state"}  # Gym atari games have no states
+    env_creator = EnvCreator(gym_atari_env_creator, game, **wrapconf)
     register_env(registername, env_creator)
-    return partial(env_creator, {})
+    return env_creator
 
 
 BACKENDS = {
@@ -95,34 +140,14 @@ BACKENDS = {
 }
 
 
-def register_retro(game, state, **kwargs):
-    """Registers a given retro game as a ray environment
-
-    The environment is registered with name 'retro-v0'
-    """
-    base = retro.make(game=game, state=state)
-    base = envs.ButtonsRemapper(base, game)
-    env_creator = lambda env_config: make_env(base=base, **kwargs)
-    register_env("retro-v0", env_creator)
-    return partial(env_creator, {})
-
-
-def register_atari(game, **kwargs):
-    """Registers a given gym Atari game as a ray environment
-
-    The environment is registered with name 'retro-v0'
-    """
-    base = gym.make(game)
-    env_creator = lambda env_config: make_env(base=base, **kwargs)
-    register_env("retro-v0", env_creator)
-    return partial(env_creator, {})
+"""Algorithm configuration parameters.
 
-
-"""Algorithm configuration parameters."""
+Default configurations are given as (module, attribute) pairs, and only imported for the algorithm in use.
+"""
 ALGORITHMS = {
     # Parameters from https://github.com/ray-project/ray/blob/master/python/ray/rllib/tuned_examples/pong-rainbow.yaml
     "DQN": {  # DQN Rainbow
-        "default_conf": dqn.DEFAULT_CONFIG,
+        "default_conf": ("ray.rllib.agents.dqn", "DEFAULT_CONFIG"),
         "conf": {
             "num_atoms": 51,
             "noisy": True,
@@ -140,7 +165,7 @@ ALGORITHMS = {
     },
     # Parameters from https://github.com/ray-project/ray/blob/master/python/ray/rllib/tuned_examples/atari-ppo.yaml
     "PPO": {
-        "default_conf": ppo.DEFAULT_CONFIG,
+        "default_conf": ("ray.rllib.agents.ppo", "DEFAULT_CONFIG"),
         "conf": {
             "lambda": 0.95,
             "kl_coeff": 0.5,
@@ -148,7 +173,9 @@ ALGORITHMS = {
             "entropy_coeff": 0.01,
             "sample_batch_size": 500,
             "num_sgd_iter": 10,
-            "num_envs_per_worker": 1,
+            # Same as RLLib defaults, made explicit: rollout workers run on CPU, the GPU is only used by the learner
+            "num_cpus_per_worker": 1,
+            "num_gpus_per_worker": 0,
             "batch_mode": "truncate_episodes",
             "observation_filter": "NoFilter",
             "vf_share_layers": True,
@@ -162,7 +189,7 @@ ALGORITHMS = {
     # Parameters from https://github.com/ray-project/ray/blob/master/python/ray/rllib/tuned_examples/atari-ppo.yaml
     # TODO: testing
     "PPORND": {
-        "default_conf": rnd.DEFAULT_CONFIG,
+        "default_conf": ("rnd", "DEFAULT_CONFIG"),
         "conf": {
             "lambda": 0.95,
             "kl_coeff": 0.5,
@@ -170,7 +197,9 @@ ALGORITHMS = {
             "entropy_coeff": 0.01,
             "sample_batch_size": 500,
             "num_sgd_iter": 10,
-            "num_envs_per_worker": 1,
+            # Same as RLLib defaults, made explicit: rollout workers run on CPU, the GPU is only used by the learner
+            "num_cpus_per_worker": 1,
+            "num_gpus_per_worker": 0,
             "batch_mode": "truncate_episodes",
             "observation_filter": "NoFilter",
             "vf_share_layers": True,
@@ -184,11 +213,10 @@ ALGORITHMS = {
     # Parameters from https://github.com/ray-project/ray/blob/master/python/ray/rllib/tuned_examples/atari-impala.yaml
     #  and IMPALA paper https://arxiv.org/abs/1802.01561 Appendix G
     "IMPALA": {
-        "default_conf": impala.DEFAULT_CONFIG,
+        "default_conf": ("ray.rllib.agents.impala", "DEFAULT_CONFIG"),
         "conf": {
             'sample_batch_size': 20,  # Unroll length
             'train_batch_size': 32,
-            'num_envs_per_worker': 1,
             'lr_schedule': [
                 [0, 0.0006],
                 [200000000, 0.000000000001],
@@ -197,34 +225,58 @@ ALGORITHMS = {
             "opt_type": "rmsprop",
             "momentum": 0.0,
             "epsilon": 0.01,
-            #"num_data_loader_buffers": 4,
-            #"minibatch_buffer_size": 4,
-            #"num_sgd_iter": 2
+            # Keep several batches loaded in the GPU while it is training on another one
+            "num_data_loader_buffers": 4,
+            "minibatch_buffer_size": 4,
+            "num_sgd_iter": 2,
+            # Same as RLLib default, made explicit: send updated weights to workers after every learner step
+            "broadcast_interval": 1,
             # Ideal use setting should be 1 GPU, 80 workers
         }
     },
     # Random agent for testing purposes
     "random": {
-        "default_conf": {},
+        "default_conf": None,
         "conf": {}
     }
 }
 
 
+@lru_cache(maxsize=None)
 def get_agent_class(alg):
     """Returns the class of a known agent given its name."""
     if alg == "PPORND":
         # TODO: testing
-        return rnd.PPORNDAgent
+        return importlib.import_module("rnd").PPORNDAgent
     else:
         return registry.get_agent_class(alg)
 
 
-def create_config(alg="PPO", workers=4, entropycoeff=None, lstm=None, model=None):
-    """Returns a learning algorithm configuration"""
+def get_default_config(alg):
+    """Returns the default configuration of a known algorithm, importing only the module that defines it"""
+    if ALGORITHMS[alg]["default_conf"] is None:
+        return {}
+    module, attribute = ALGORITHMS[alg]["default_conf"]
+    return getattr(importlib.import_module(module), attribute)
+
+
+def create_config(alg="PPO", workers=4, entropycoeff=None, lstm=None, model=None, envsperworker=None):
+    """Returns a learning algorithm configuration
+
+    The configuration is only built once for each set of arguments. Each call returns a shallow copy of it, so that
+    top level keys can be modified freely by the caller.
+    """
+    return dict(_create_config(alg, workers, entropycoeff, lstm, model, envsperworker))
+
+
+@lru_cache(maxsize=None)
+def _create_config(alg, workers, entropycoeff, lstm, model, envsperworker):
+    """Builds a learning algorithm configuration by merging the defaults of the algorithm with our parameters"""
     if alg not in ALGORITHMS:
         raise ValueError(f"Unknown algorithm {alg}, must be one of {list(ALGORITHMS.keys())}")
-    config = {**ALGORITHMS[alg]["default_conf"], **ALGORITHMS[alg]["conf"], **{"num_workers": workers}}
+    config = {**get_default_config(alg), **ALGORITHMS[alg]["conf"], **{"num_workers": workers}}
+    if envsperworker is not None:
+        config["num_envs_per_worker"] = envsperworker
     if entropycoeff is not None:
         config["entropy_coeff"] = np.sign(config["entropy_coeff"]) * entropycoeff  # Each alg uses different sign
     if model is not None:
@@ -242,18 +294,69 @@ def create_config(alg="PPO", workers=4, entropycoeff=None, lstm=None, model=None
     return config
 
 
+def list_files(folder):
+    """Returns the paths of all files found under a folder, recursively"""
+    return [os.path.join(root, file) for root, _, files in os.walk(folder) for file in files]
+
+
+def import_roms(paths):
+    """Imports into Gym Retro those files in the given list that are known ROMs"""
+    retro.data.merge(*paths, quiet=False)
+
+
+def import_roms_async(executor, folder, ntasks):
+    """Launches parallel import tasks in a local process pool, each one in charge of a share of the ROMs in a folder
+
+    ROMs must be imported in this machine, so Ray tasks, which could be scheduled in other nodes, are not used.
+    Returns the list of futures of the launched tasks.
+    """
+    paths = list_files(folder)
+    return [executor.submit(import_roms, paths[i::ntasks]) for i in range(min(ntasks, len(paths)))]
+
+
 def get_node_ips():
-    """Returns a set with all IP addressess of nodes in the Ray cluster"""
-    @ray.remote
-    def f():
-        time.sleep(0.01)
-        return ray.services.get_node_ip_address()
+    """Returns a set with all IP addressess of nodes alive in the Ray cluster"""
+    return {client["NodeManagerAddress"] for client in ray.global_state.client_table()
+            if client.get("IsInsertion", True)}
+
+
+# Maximum number of checkpoints being written to disk at the same time
+MAX_PENDING_CHECKPOINTS = 2
+
 
-    return set(ray.get([f.remote() for _ in range(1000)]))
+def write_checkpoint(checkpoint, state, metadata):
+    """Writes an agent state and its metadata to disk, in the same layout as Agent.save"""
+    os.makedirs(os.path.dirname(checkpoint), exist_ok=True)
+    with open(checkpoint, "wb") as f:
+        pickle.dump(state, f)
+    # Metadata goes last, so that interrupted writes don't leave a restorable checkpoint behind
+    with open(checkpoint + ".tune_metadata", "wb") as f:
+        pickle.dump(metadata, f)
+
+
+def save_async(agent, executor):
+    """Saves a checkpoint of the agent that can be loaded with agent.restore, writing it to disk in the background
+
+    The agent state is snapshotted right away, only its serialization and disk I/O run in the executor.
+    Returns the path of the checkpoint and the future of the write task.
+    """
+    checkpoint = os.path.join(agent.logdir, f"checkpoint_{agent.iteration}", f"checkpoint-{agent.iteration}")
+    metadata = {
+        "experiment_id": agent._experiment_id,
+        "iteration": agent._iteration,
+        "timesteps_total": agent._timesteps_total,
+        "time_total": agent._time_total,
+        "episodes_total": agent._episodes_total,
+        "saved_as_dict": False
+    }
+    return checkpoint, executor.submit(write_checkpoint, checkpoint, agent.__getstate__(), metadata)
 
 
 def train(config, alg, checkpoint=None):
-    """Trains a policy network"""
+    """Trains a policy network
+
+    Checkpoints are pickled and written to disk in a background thread, so that training is not stalled by disk I/O.
+    """
     agent = get_agent_class(alg)(config=config, env="retro-v0")
     if checkpoint is not None:
         try:
@@ -264,26 +367,55 @@ def train(config, alg, checkpoint=None):
     else:
         print("Started policy network from scratch")
 
-    for i in range(1000000):
-        # Perform one iteration of training the policy with the algorithm
-        result = agent.train()
-        print(pretty_print(result))
+    pending = []
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        for i in range(1000000):
+            # Perform one iteration of training the policy with the algorithm
+            result = agent.train()
+            print(pretty_print(result))
 
-        if i % 50 == 0:
-            checkpoint = agent.save()
-            print("checkpoint saved at", checkpoint)
+            if i % 50 == 0:
+                checkpoint, task = save_async(agent, executor)
+                pending.append(task)
+                print("checkpoint saving at", checkpoint)
+                # Wait for older writes to finish, so that serialized checkpoints don't pile up in memory
+                while len(pending) > MAX_PENDING_CHECKPOINTS:
+                    pending.pop(0).result()
+
+
+def load_agent(config, alg, checkpoint):
+    """Creates an agent and restores its trained model from a checkpoint"""
+    agent = get_agent_class(alg)(config=config, env="retro-v0")
+    if checkpoint is None:
+        raise ValueError(f"A previously trained checkpoint must be provided for algorithm {alg}")
+    agent.restore(checkpoint)
+    return agent
+
+
+# Maximum rate at which test episodes are rendered, in frames per second
+RENDER_FPS = 60
 
 
 def test(config, alg, checkpoint=None, testdelay=0, render=False, envcreator=None, maxepisodelen=10000000):
-    """Tests and renders a previously trained model"""
+    """Tests and renders a previously trained model
+
+    Rendering is limited to RENDER_FPS frames per second, any faster would not be displayed anyway.
+    """
     if alg == "random":
         env = envcreator()
     else:
-        agent = get_agent_class(alg)(config=config, env="retro-v0")
-        if checkpoint is None:
-            raise ValueError(f"A previously trained checkpoint must be provided for algorithm {alg}")
-        agent.restore(checkpoint)
+        agent = load_agent(config, alg, checkpoint)
         env = agent.local_evaluator.env
+    n_actions = env.action_space.n
+    last_render = time.monotonic()
+    # Local bindings for the functions called at every step of the loop below
+    randint = np.random.randint
+    compute = agent.compute_action if alg != "random" else None
+    step_env = env.step
+    render_env = env.render if render else None
+    sleep = time.sleep
+    monotonic = time.monotonic
+    render_interval = 1 / RENDER_FPS
 
     while True:
         state = env.reset()
@@ -291,20 +423,55 @@ def test(config, alg, checkpoint=None, testdelay=0, render=False, envcreator=Non
         reward_total = 0.0
         step = 0
         while not done and step < maxepisodelen:
-            if alg == "random":
-                action = np.random.choice(range(env.action_space.n))
+            if compute is None:
+                action = randint(n_actions)
             else:
-                action = agent.compute_action(state)
-            next_state, reward, done, _ = env.step(action)
-            time.sleep(testdelay)
+                action = compute(state)
+            next_state, reward, done, _ = step_env(action)
+            if testdelay > 0:
+                sleep(testdelay)
             reward_total += reward
-            if render:
-                env.render()
+            if render_env is not None:
+                now = monotonic()
+                if now - last_render >= render_interval:
+                    render_env()
+                    last_render = now
             state = next_state
             step = step + 1
         print("Episode reward", reward_total)
 
 
+def test_parallel(config, alg, checkpoint=None, envcreator=None, maxepisodelen=10000000, nenvs=2):
+    """Tests a previously trained model on several episodes at once, each one run by a remote environment actor
+
+    All environments are reset and stepped in parallel, rendering is not supported.
+    """
+    remoteenvs = [RemoteEnv.remote(envcreator) for _ in range(nenvs)]
+    if alg == "random":
+        n_actions = ray.get(remoteenvs[0].action_space.remote()).n
+        compute = lambda state: np.random.randint(n_actions)
+    else:
+        compute = load_agent(config, alg, checkpoint).compute_action
+
+    while True:
+        states = ray.get([env.reset.remote() for env in remoteenvs])
+        rewards_total = np.zeros(nenvs)
+        active = list(range(nenvs))
+        step = 0
+        while active and step < maxepisodelen:
+            results = ray.get([remoteenvs[i].step.remote(compute(states[i])) for i in active])
+            stillactive = []
+            for i, (next_state, reward, done, _) in zip(active, results):
+                states[i] = next_state
+                rewards_total[i] += reward
+                if not done:
+                    stillactive.append(i)
+            active = stillactive
+            step = step + 1
+        for reward_total in rewards_total:
+            print("Episode reward", reward_total)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Agent that learns how to play a retro game by using RLLib.')
     parser.add_argument('game', type=str, help='Game to play. Must be a valid Gym Retro game')
@@ -330,6 +497,9 @@ if __name__ == "__main__":
                         help='Save videos of test episodes in form of processed frames. '
                              'Modes similar to those of --makemovie')
     parser.add_argument('--maxepisodelen', type=int, default=1000000, help='Maximum length of test episodes')
+    parser.add_argument('--testenvs', type=int, default=1,
+                        help='Number of test episodes to run in parallel, each in its own Ray actor. '
+                             'Rendering and test delays are only supported for 1')
     parser.add_argument('--algorithm', type=str, default="IMPALA",
                         help=f'Algorithm to use for training: {list(ALGORITHMS.keys())}')
     parser.add_argument('--model', type=str, default=None,
@@ -337,6 +507,9 @@ if __name__ == "__main__":
     parser.add_argument('--lstm', type=int, default=None,
                         help=f'Length of sequences to feed into the LSTM layer (default: no LSTM layer)')
     parser.add_argument('--workers', type=int, default=4, help='Number of workers to use during training')
+    parser.add_argument('--envsperworker', type=int, default=None,
+                        help='Number of environments run by each worker, so that their policy evaluations are batched '
+                             '(default: 1). Only supported by the gym-atari backend')
     parser.add_argument('--localworkers', type=int, default=None, help='Number of local workers to use in this machine (default: equal to "workers")')
     parser.add_argument('--timepenalty', type=float, default=0, help='Reward penalty to apply to each timestep')
     parser.add_argument('--entropycoeff', type=float, default=None, help='Entropy bonus to apply to diverse actions')
@@ -347,20 +520,23 @@ if __name__ == "__main__":
     parser.add_argument('--waitfornodes', type=int, default=None,
                         help="Wait until at least this number of nodes is available in the Ray cluster")
     parser.add_argument('--redisaddress', type=str, default=None, help="Redis address of Ray server to connect to")
+    parser.add_argument('--verbose', action='store_true', help='Print the full algorithm configuration')
     parser.add_argument('--importroms', type=str, default=None, help='Import roms from given folder before start')
 
     args = parser.parse_args()
 
+    # Retro supports a single emulator per process, and RLLib creates all the environments of a worker in its process
+    if args.backend == "retro" and args.envsperworker is not None and args.envsperworker > 1:
+        raise ValueError("The retro backend supports a single environment per worker")
+    if args.testenvs > 1 and (args.render or args.testdelay > 0):
+        raise ValueError("--render and --testdelay are not supported when running several test episodes in parallel")
+
     if args.localworkers is None:
         args.localworkers = args.workers
 
     # Shutdown other ray processes to avoid runnig several trainings in parallel
     ray.shutdown()
 
-    # Import ROMs if requested
-    if args.importroms is not None:
-        subprocess.run(["python", "-m", "retro.import", args.importroms])
-
     # Check backend
     if args.backend not in BACKENDS:
         raise ValueError(f"Unknown backend {args.backend}, must be one of {list(BACKENDS.keys())}")
@@ -374,8 +550,15 @@ if __name__ == "__main__":
                                           makeprocessedmovie=args.makeprocessedmovie, cliprewards=args.cliprewards)
 
     config = create_config(args.algorithm, workers=args.workers, entropycoeff=args.entropycoeff, model=args.model,
-                           lstm=args.lstm)
-    print(f"Config: {json.dumps(config, indent=4, sort_keys=True)}")
+                           lstm=args.lstm, envsperworker=args.envsperworker)
+    if args.verbose:
+        print(f"Config: {json.dumps(config, indent=4, sort_keys=True)}", file=sys.stderr)
+
+    # Import ROMs if requested, in the background while starting Ray and waiting for the cluster to be ready
+    importexecutor = ProcessPoolExecutor(max_workers=args.localworkers)
+    importtasks = []
+    if args.importroms is not None:
+        importtasks = import_roms_async(importexecutor, args.importroms, args.localworkers)
 
     ray.init(num_cpus=args.localworkers, num_gpus=1, redis_address=args.redisaddress)
 
@@ -391,7 +574,15 @@ if __name__ == "__main__":
             time.sleep(5)
             nodes = get_node_ips()
 
-    if args.test:
+    # ROMs must be available before creating any environment
+    for task in importtasks:
+        task.result()
+    importexecutor.shutdown()
+
+    if args.test and args.testenvs > 1:
+        test_parallel(config, args.algorithm, checkpoint=args.checkpoint, envcreator=envcreator,
+                      maxepisodelen=args.maxepisodelen, nenvs=args.testenvs)
+    elif args.test:
         test(config, args.algorithm, checkpoint=args.checkpoint, testdelay=args.testdelay,
              render=args.render, envcreator=envcreator, maxepisodelen=args.maxepisodelen)
     else: